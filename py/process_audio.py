@@ -3,13 +3,18 @@ import sys
 from dataclasses import dataclass
 from datetime import timedelta
 from pathlib import Path
-from typing import Dict, List, Optional, Sequence, Tuple
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
 
 import librosa
 import numpy as np
 import srt
 from faster_whisper import WhisperModel
-from sklearn.cluster import AgglomerativeClustering
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.cluster.hierarchy import fcluster, linkage
+from scipy.fft import dct
+from scipy.ndimage import convolve1d
+from scipy.spatial.distance import squareform
+from sklearn.decomposition import PCA
 from sklearn.metrics import silhouette_score
 
 
@@ -21,6 +26,16 @@ class SpeechSegment:
   text: str = ''
 
 
+@dataclass
+class DiarizedSegments:
+  starts: np.ndarray
+  ends: np.ndarray
+  speakers: np.ndarray
+
+  def __len__(self) -> int:
+    return len(self.starts)
+
+
 DEFAULT_VAD_OPTIONS = {
   'frame_length': 0.03,
   'hop_length': 0.01,
@@ -34,6 +49,12 @@ DEFAULT_DIARIZATION_OPTIONS = {
   'max_speakers': 6
 }
 
+SILHOUETTE_SAMPLE_SIZE = 500
+
+ASR_BATCH_SIZE = 256
+
+DELTA_KERNEL = np.array([1, -8, 0, 8, -1], dtype=np.float32) / 12
+
 DEFAULT_ASR_OPTIONS = {
   'model': 'medium',
   'device': 'cpu',
@@ -45,10 +66,35 @@ DEFAULT_ASR_OPTIONS = {
 
 
 def format_timestamp(value: float, separator: str = '.') -> str:
-  hours = int(value // 3600)
-  minutes = int((value % 3600) // 60)
-  seconds = value % 60
-  return f"{hours:02d}:{minutes:02d}:{seconds:06.3f}".replace('.', separator)
+  ms = int(round(value * 1000))
+  hours, ms = divmod(ms, 3_600_000)
+  minutes, ms = divmod(ms, 60_000)
+  seconds, ms = divmod(ms, 1000)
+  return f"{hours:02d}:{minutes:02d}:{seconds:02d}{separator}{ms:03d}"
+
+
+def _collapse_segments(
+  speech_flags: np.ndarray,
+  hop_length: float,
+  frame_length: float,
+  min_silence: float,
+  audio_duration: float
+) -> np.ndarray:
+  edges = np.diff(speech_flags.astype(np.int8), prepend=0, append=0)
+  run_starts = np.flatnonzero(edges == 1)
+  run_ends = np.flatnonzero(edges == -1)
+  if len(run_starts) == 0:
+    return np.zeros((0, 2), dtype=np.float64)
+
+  seg_starts = run_starts * hop_length
+  seg_ends = np.minimum(audio_duration, run_ends * hop_length + frame_length)
+  seg_ends[run_ends == len(speech_flags)] = audio_duration
+
+  opens_segment = np.ones(len(seg_starts), dtype=bool)
+  opens_segment[1:] = seg_starts[1:] - seg_ends[:-1] >= min_silence
+  heads = np.flatnonzero(opens_segment)
+  tails = np.append(heads[1:] - 1, len(seg_starts) - 1)
+  return np.column_stack([seg_starts[heads], seg_ends[tails]])
 
 
 def energy_vad(
@@ -64,19 +110,15 @@ def energy_vad(
 
   frame_samples = max(1, int(frame_length * sr))
   hop_samples = max(1, int(hop_length * sr))
+  duration = len(audio) / sr
 
   if len(audio) < frame_samples:
-    return [(0.0, len(audio) / sr)]
-
-  energies: List[float] = []
-  for start in range(0, len(audio) - frame_samples + 1, hop_samples):
-    frame = audio[start:start + frame_samples]
-    energy = float(np.sqrt(np.mean(frame ** 2)))
-    energies.append(energy)
+    return [(0.0, duration)]
 
-  energies_np = np.array(energies, dtype=np.float32)
+  windows = sliding_window_view(audio.astype(np.float32, copy=False), frame_samples)[::hop_samples]
+  energies_np = np.sqrt(np.einsum('ij,ij->i', windows, windows) / frame_samples).astype(np.float32, copy=False)
   if len(energies_np) == 0:
-    return [(0.0, len(audio) / sr)]
+    return [(0.0, duration)]
 
   if manual_threshold is not None:
     threshold = float(manual_threshold)
@@ -86,198 +128,303 @@ def energy_vad(
   print(f"Порог энергии: {threshold:.6f}")
 
   speech_flags = energies_np > threshold
-  segments: List[Tuple[float, float]] = []
-  current_start: Optional[int] = None
-
-  for index, is_speech in enumerate(speech_flags):
-    if is_speech and current_start is None:
-      current_start = index
-    elif not is_speech and current_start is not None:
-      seg_start = current_start * hop_length
-      seg_end = min(len(audio) / sr, index * hop_length + frame_length)
-      if segments and seg_start - segments[-1][1] < min_silence:
-        prev_start, _ = segments[-1]
-        segments[-1] = (prev_start, seg_end)
-      else:
-        segments.append((seg_start, seg_end))
-      current_start = None
-
-  if current_start is not None:
-    seg_start = current_start * hop_length
-    seg_end = len(audio) / sr
-    if segments and seg_start - segments[-1][1] < min_silence:
-      prev_start, _ = segments[-1]
-      segments[-1] = (prev_start, seg_end)
-    else:
-      segments.append((seg_start, seg_end))
-
-  refined: List[Tuple[float, float]] = []
-  for seg_start, seg_end in segments:
-    if seg_end - seg_start >= min_speech:
-      refined.append((seg_start, seg_end))
+  collapsed = _collapse_segments(speech_flags, hop_length, frame_length, min_silence, duration)
+  keep = collapsed[:, 1] - collapsed[:, 0] >= min_speech
+  refined = [(float(seg_start), float(seg_end)) for seg_start, seg_end in collapsed[keep]]
 
   if not refined:
-    refined = [(0.0, len(audio) / sr)]
+    refined = [(0.0, duration)]
 
   print(f"После VAD сегментов: {len(refined)}")
   return refined
 
 
+def _fused_mfcc_delta_delta2(
+  audio: np.ndarray,
+  sr: int,
+  hop_length: int,
+  n_fft: int = 2048,
+  block_frames: int = 4096
+) -> np.ndarray:
+  mel_basis = librosa.filters.mel(sr=sr, n_fft=n_fft, n_mels=40).astype(np.float32, copy=False)
+  padded = np.pad(audio, n_fft // 2, mode='constant')
+  total_frames = 1 + len(audio) // hop_length
+  logmel = np.empty((mel_basis.shape[0], total_frames), dtype=np.float32)
+
+  # Only one block of the 1 + n_fft/2 row spectrum is alive at a time.
+  for f0 in range(0, total_frames, block_frames):
+    f1 = min(total_frames, f0 + block_frames)
+    block = padded[f0 * hop_length:(f1 - 1) * hop_length + n_fft]
+    spectrum = librosa.stft(block, n_fft=n_fft, hop_length=hop_length, center=False)
+    logmel[:, f0:f1] = np.log(mel_basis @ (np.abs(spectrum) ** 2) + 1e-10)
+
+  mfcc = dct(logmel, axis=0, type=2, norm='ortho')[:13]
+  # convolve1d flips the weights; reverse them so delta keeps the sign of d/dt
+  delta = convolve1d(mfcc, DELTA_KERNEL[::-1], axis=1, mode='nearest')
+  delta2 = convolve1d(delta, DELTA_KERNEL[::-1], axis=1, mode='nearest')
+  return np.vstack([mfcc, delta, delta2])
+
+
+def _extract_one(
+  out: np.ndarray,
+  stack_full: np.ndarray,
+  n_samples: int,
+  sr: int,
+  hop: int,
+  min_frames: int,
+  seg_start: float,
+  seg_end: float
+) -> None:
+  start_idx = max(0, int(seg_start * sr))
+  end_idx = min(n_samples, int(seg_end * sr))
+  if end_idx <= start_idx:
+    out[:] = 0.0
+    return
+
+  total_frames = stack_full.shape[1]
+  f0 = start_idx // hop
+  f1 = min(total_frames, -(-end_idx // hop))
+  if f1 - f0 < min_frames:
+    f0 = max(0, f0 - (min_frames - (f1 - f0)) // 2)
+    f1 = min(total_frames, f0 + min_frames)
+    f0 = max(0, f1 - min_frames)
+
+  stack = stack_full[:, f0:f1]
+  n_rows = stack.shape[0]
+  np.mean(stack, axis=1, out=out[:n_rows])
+  np.std(stack, axis=1, out=out[n_rows:])
+
+
 def extract_features(audio: np.ndarray, sr: int, segments: Sequence[Tuple[float, float]]) -> np.ndarray:
-  feature_vectors: List[np.ndarray] = []
-  min_samples = int(0.25 * sr)
   feature_dim = 78
+  hop = 512
+  min_frames = max(1, int(np.ceil(0.25 * sr / hop)))
 
-  for seg_start, seg_end in segments:
-    start_idx = max(0, int(seg_start * sr))
-    end_idx = min(len(audio), int(seg_end * sr))
-    segment_audio = audio[start_idx:end_idx]
-    if len(segment_audio) == 0:
-      feature_vectors.append(np.zeros(feature_dim, dtype=np.float32))
-      continue
-    if len(segment_audio) < min_samples:
-      pad_width = min_samples - len(segment_audio)
-      segment_audio = np.pad(segment_audio, (0, pad_width), mode='edge')
-
-    mfcc = librosa.feature.mfcc(y=segment_audio, sr=sr, n_mfcc=13)
-    delta = librosa.feature.delta(mfcc)
-    delta2 = librosa.feature.delta(mfcc, order=2)
-    stack = np.vstack([mfcc, delta, delta2])
-    feat_vec = np.concatenate([np.mean(stack, axis=1), np.std(stack, axis=1)])
-    feature_vectors.append(feat_vec.astype(np.float32))
-
-  if not feature_vectors:
+  if not segments:
     return np.zeros((0, feature_dim), dtype=np.float32)
 
-  return np.vstack(feature_vectors)
+  stack_full = _fused_mfcc_delta_delta2(audio, sr, hop).astype(np.float32, copy=False)
+  n_samples = len(audio)
+  out = np.empty((len(segments), feature_dim), dtype=np.float32)
+
+  for i, (s, e) in enumerate(segments):
+    _extract_one(out[i], stack_full, n_samples, sr, hop, min_frames, s, e)
+
+  return out
 
 
-def estimate_speaker_count(features: np.ndarray, diar_options: Dict[str, int]) -> int:
+def _speaker_linkage(features: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+  feats = features.astype(np.float32, copy=False)
+  if feats.shape[0] > 32:
+    pca = PCA(n_components=min(16, feats.shape[0] - 1, feats.shape[1]))
+    feats = pca.fit_transform(feats).astype(np.float32, copy=False)
+  feats = feats / (np.linalg.norm(feats, axis=1, keepdims=True) + np.float32(1e-12))
+  distances = 1.0 - feats @ feats.T
+  np.fill_diagonal(distances, 0.0)
+  np.clip(distances, 0.0, 2.0, out=distances)
+  tree = linkage(squareform(distances, checks=False), method='average')
+  return distances, tree
+
+
+def estimate_speaker_count(
+  features: np.ndarray,
+  diar_options: Dict[str, int],
+  weights: Optional[np.ndarray] = None
+) -> Tuple[int, np.ndarray]:
+  single_labels = np.zeros(features.shape[0], dtype=np.int64)
   if features.shape[0] <= 1:
-    return 1
+    return 1, single_labels
 
   num_speakers = diar_options.get('num_speakers')
   if num_speakers:
-    return max(1, int(num_speakers))
+    num_speakers = max(1, int(num_speakers))
+    if num_speakers == 1:
+      return 1, single_labels
+    _, tree = _speaker_linkage(features)
+    return num_speakers, fcluster(tree, t=num_speakers, criterion='maxclust') - 1
 
   min_speakers = int(diar_options.get('min_speakers', DEFAULT_DIARIZATION_OPTIONS['min_speakers']))
   max_speakers = int(diar_options.get('max_speakers', DEFAULT_DIARIZATION_OPTIONS['max_speakers']))
+  min_speakers = max(2, min_speakers)
   max_speakers = min(max_speakers, features.shape[0])
+  if min_speakers > max_speakers:
+    print('Оценено количество спикеров: 1')
+    return 1, single_labels
+
+  distances, tree = _speaker_linkage(features)
   best_score = -1.0
   best_k = 1
+  best_labels = single_labels
+
+  sample = slice(None)
+  sample_distances = distances
+  if features.shape[0] > SILHOUETTE_SAMPLE_SIZE:
+    probabilities = None
+    if weights is not None:
+      weights = np.clip(np.asarray(weights, dtype=np.float64), 1e-6, None)
+      probabilities = weights / weights.sum()
+    rng = np.random.default_rng(0)
+    sample = np.sort(rng.choice(features.shape[0], SILHOUETTE_SAMPLE_SIZE, replace=False, p=probabilities))
+    sample_distances = distances[np.ix_(sample, sample)]
 
   for k in range(min_speakers, max_speakers + 1):
-    if k <= 1 or k > features.shape[0]:
-      continue
-    clustering = AgglomerativeClustering(n_clusters=k)
-    labels = clustering.fit_predict(features)
-    if len(set(labels)) <= 1:
+    labels = fcluster(tree, t=k, criterion='maxclust')
+    sample_labels = labels[sample]
+    n_labels = len(set(sample_labels))
+    if n_labels <= 1 or n_labels >= len(sample_labels):
       continue
-    score = silhouette_score(features, labels)
+    score = silhouette_score(sample_distances, sample_labels, metric='precomputed')
     if score > best_score:
       best_score = score
       best_k = k
+      best_labels = labels - 1
 
   if best_k <= 1:
     best_k = 1
+    best_labels = single_labels
 
   print(f"Оценено количество спикеров: {best_k}")
-  return best_k
+  return best_k, best_labels
 
 
-def diarize_segments(segments: Sequence[Tuple[float, float]], features: np.ndarray, diar_options: Dict[str, int]) -> List[SpeechSegment]:
+def diarize_segments(segments: Sequence[Tuple[float, float]], features: np.ndarray, diar_options: Dict[str, int]) -> DiarizedSegments:
   if not segments:
-    return []
+    empty = np.zeros(0, dtype=np.float64)
+    return DiarizedSegments(starts=empty, ends=empty, speakers=np.zeros(0, dtype=np.int64))
 
-  num_speakers = estimate_speaker_count(features, diar_options)
+  bounds = np.asarray(segments, dtype=np.float64)
+  num_speakers, labels = estimate_speaker_count(features, diar_options, bounds[:, 1] - bounds[:, 0])
 
   if num_speakers <= 1:
-    return [SpeechSegment(start=s, end=e, speaker=0) for s, e in segments]
-
-  clustering = AgglomerativeClustering(n_clusters=num_speakers)
-  labels = clustering.fit_predict(features)
+    labels = np.zeros(len(bounds), dtype=np.int64)
 
-  diarized = [SpeechSegment(start=s, end=e, speaker=int(labels[idx])) for idx, (s, e) in enumerate(segments)]
-  diarized.sort(key=lambda seg: seg.start)
-  return diarized
+  order = np.argsort(bounds[:, 0], kind='stable')
+  return DiarizedSegments(
+    starts=np.ascontiguousarray(bounds[order, 0]),
+    ends=np.ascontiguousarray(bounds[order, 1]),
+    speakers=np.asarray(labels, dtype=np.int64)[order]
+  )
 
 
 def assign_speaker_for_interval(
   start: float,
   end: float,
-  segments: Sequence[SpeechSegment]
+  diarized: DiarizedSegments
 ) -> int:
-  if not segments:
+  if len(diarized) == 0:
     return 0
 
+  starts = diarized.starts
+  ends = diarized.ends
+
+  lo = int(np.searchsorted(ends, start, side='right'))
+  hi = int(np.searchsorted(starts, end, side='left'))
+  if hi > lo:
+    overlaps = np.minimum(end, ends[lo:hi]) - np.maximum(start, starts[lo:hi])
+    return int(diarized.speakers[lo + int(np.argmax(overlaps))])
+
   midpoint = (start + end) / 2.0
-  best_index = None
-  best_overlap = 0.0
+  neighbors = slice(max(0, lo - 1), min(len(diarized), lo + 1))
+  distances = np.minimum(np.abs(midpoint - starts[neighbors]), np.abs(midpoint - ends[neighbors]))
+  return int(diarized.speakers[neighbors.start + int(np.argmin(distances))])
+
+
+def assign_speakers(starts: np.ndarray, ends: np.ndarray, diarized: DiarizedSegments) -> np.ndarray:
+  speakers = np.zeros(len(starts), dtype=np.int64)
+  if len(starts) == 0 or len(diarized) == 0:
+    return speakers
+
+  lo = int(np.searchsorted(diarized.ends, starts.min(), side='right'))
+  hi = int(np.searchsorted(diarized.starts, ends.max(), side='left'))
+  missing = np.ones(len(starts), dtype=bool)
+  if hi > lo:
+    overlaps = np.maximum(
+      0.0,
+      np.minimum(ends[:, None], diarized.ends[None, lo:hi]) - np.maximum(starts[:, None], diarized.starts[None, lo:hi])
+    )
+    best = np.argmax(overlaps, axis=1)
+    speakers[:] = diarized.speakers[lo + best]
+    missing = overlaps[np.arange(len(starts)), best] <= 0.0
 
-  for idx, segment in enumerate(segments):
-    overlap = min(end, segment.end) - max(start, segment.start)
-    if overlap > best_overlap:
-      best_overlap = overlap
-      best_index = idx
-    if segment.start <= midpoint <= segment.end:
-      return segment.speaker
+  for idx in np.flatnonzero(missing):
+    speakers[idx] = assign_speaker_for_interval(float(starts[idx]), float(ends[idx]), diarized)
+  return speakers
 
-  if best_index is not None:
-    return segments[best_index].speaker
 
-  distances = [min(abs(midpoint - seg.start), abs(midpoint - seg.end)) for seg in segments]
-  return segments[int(np.argmin(distances))].speaker
+def _merge_batch(
+  merged: List[SpeechSegment],
+  batch: List[Tuple[float, float, str]],
+  diarized_segments: DiarizedSegments,
+  merge_gap: float
+):
+  bounds = np.array([(start, end) for start, end, _ in batch], dtype=np.float64)
+  speakers = assign_speakers(bounds[:, 0], bounds[:, 1], diarized_segments)
+
+  for (start, end, text), speaker in zip(batch, speakers.tolist()):
+    if merged and merged[-1].speaker == speaker and start - merged[-1].end <= merge_gap:
+      merged[-1].end = end
+      merged[-1].text = (merged[-1].text + ' ' + text).strip()
+    else:
+      merged.append(SpeechSegment(start=start, end=end, speaker=speaker, text=text))
 
 
 def merge_transcript_segments(
-  transcript_segments,
-  diarized_segments: Sequence[SpeechSegment],
+  transcript_segments: Iterable,
+  diarized_segments: DiarizedSegments,
   merge_gap: float
-) -> List[SpeechSegment]:
+) -> Tuple[List[SpeechSegment], int]:
   merged: List[SpeechSegment] = []
+  batch: List[Tuple[float, float, str]] = []
+  asr_count = 0
 
   for seg in transcript_segments:
+    asr_count += 1
     text = seg.text.strip()
     if not text:
       continue
-    speaker = assign_speaker_for_interval(seg.start, seg.end, diarized_segments)
-    if merged and merged[-1].speaker == speaker and seg.start - merged[-1].end <= merge_gap:
-      merged[-1].end = seg.end
-      merged[-1].text = (merged[-1].text + ' ' + text).strip()
-    else:
-      speech_seg = SpeechSegment(start=seg.start, end=seg.end, speaker=speaker, text=text)
-      merged.append(speech_seg)
+    batch.append((seg.start, seg.end, text))
+    if len(batch) >= ASR_BATCH_SIZE:
+      _merge_batch(merged, batch, diarized_segments, merge_gap)
+      batch = []
 
-  return merged
+  if batch:
+    _merge_batch(merged, batch, diarized_segments, merge_gap)
 
+  return merged, asr_count
 
-def save_transcripts(
-  merged_segments: Sequence[SpeechSegment],
-  output_dir: Path
-):
-  txt_lines: List[str] = []
-  subtitles: List[srt.Subtitle] = []
 
+def _gen_subs(merged_segments: Sequence[SpeechSegment]) -> Iterator[srt.Subtitle]:
   for index, segment in enumerate(merged_segments, start=1):
     text = getattr(segment, 'text', '').strip()
     if not text:
       continue
-    time_range = f"[{format_timestamp(segment.start)}–{format_timestamp(segment.end)}]"
-    txt_lines.append(f"{time_range} Спикер {segment.speaker + 1}: {text}")
-    subtitles.append(
-      srt.Subtitle(
-        index=index,
-        start=timedelta(seconds=segment.start),
-        end=timedelta(seconds=segment.end),
-        content=f"Спикер {segment.speaker + 1}: {text}"
-      )
+    yield srt.Subtitle(
+      index=index,
+      start=timedelta(seconds=segment.start),
+      end=timedelta(seconds=segment.end),
+      content=f"Спикер {segment.speaker + 1}: {text}"
     )
 
+
+def save_transcripts(
+  merged_segments: Sequence[SpeechSegment],
+  output_dir: Path
+):
   txt_path = output_dir / 'transcript_speakers.txt'
   srt_path = output_dir / 'transcript_speakers.srt'
 
-  txt_path.write_text('\n'.join(txt_lines), encoding='utf-8')
-  srt_path.write_text(srt.compose(subtitles), encoding='utf-8')
+  with txt_path.open('w', encoding='utf-8', buffering=1 << 20) as fh:
+    separator = ''
+    for segment in merged_segments:
+      text = getattr(segment, 'text', '').strip()
+      if not text:
+        continue
+      time_range = f"[{format_timestamp(segment.start)}–{format_timestamp(segment.end)}]"
+      fh.write(f"{separator}{time_range} Спикер {segment.speaker + 1}: {text}")
+      separator = '\n'
+
+  with srt_path.open('w', encoding='utf-8', buffering=1 << 20) as fh:
+    fh.writelines(subtitle.to_srt() for subtitle in srt.sort_and_reindex(_gen_subs(merged_segments)))
 
   print(f"Сохранено: {txt_path}")
   print(f"Сохранено: {srt_path}")
@@ -307,7 +454,8 @@ def main() -> int:
 
   target_sr = 16000
   print(f'Загрузка аудио {wav_path}...')
-  audio, sr = librosa.load(wav_path, sr=target_sr, mono=True)
+  audio, sr = librosa.load(wav_path, sr=target_sr, mono=True, dtype=np.float32)
+  audio = np.ascontiguousarray(audio, dtype=np.float32)
   duration = len(audio) / sr
   print(f'Аудио загружено: {duration:.2f} с, sr={sr}')
 
@@ -326,15 +474,13 @@ def main() -> int:
     language=asr_options.get('language', DEFAULT_ASR_OPTIONS['language']),
     vad_filter=False
   )
-  transcript_segments = list(segments_iter)
-  language_info = getattr(info, 'language', asr_options.get('language', 'unknown'))
-  print(f"Получено сегментов ASR: {len(transcript_segments)} (язык: {language_info})")
-
-  merged_segments = merge_transcript_segments(
-    transcript_segments,
+  merged_segments, asr_count = merge_transcript_segments(
+    segments_iter,
     diarized_segments,
     float(asr_options.get('merge_gap', DEFAULT_ASR_OPTIONS['merge_gap']))
   )
+  language_info = getattr(info, 'language', asr_options.get('language', 'unknown'))
+  print(f"Получено сегментов ASR: {asr_count} (язык: {language_info})")
   print(f'После объединения сегментов: {len(merged_segments)}')
 
   output_dir = wav_path.parent